@@ -0,0 +1,5 @@
+import asyncio
+
+from marugoto_scraper.marugoto_scraper import main
+
+asyncio.run(main())
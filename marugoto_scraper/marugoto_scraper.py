@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
 import email.utils
+import functools
 import json
 import logging
+import math
 import os
-import re
 import time
-from typing import Dict, Iterable, Iterator, List, Sequence, Union
+from typing import (Dict, Iterable, Iterator, List, Optional, Sequence, Tuple,
+                    Union)
 
-import requests
-from requests.exceptions import HTTPError
-from requests_futures.sessions import FuturesSession
+import httpx
+import orjson
 
 import genanki
 from genanki import Deck, Model, Note, Package
@@ -17,12 +20,28 @@ from genanki import Deck, Model, Note, Package
 Words = Iterable[Dict[str, Union[str, None, List[Dict[str, str]]]]]
 
 logging.basicConfig(level=logging.INFO)
+logging.getLogger('httpx').setLevel(logging.WARNING)
 
 delimiter = '|'
 
 base_url = 'https://words.marugotoweb.jp'
 base_name = 'MARUGOTO-NO-KOTOBA'
 
+download_concurrency = 32
+max_connections = 8
+audio_timeout = httpx.Timeout(30, pool=None)
+
+
+def create_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        follow_redirects=True,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=3,
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections)))
+
+
 words_api_url = base_url + '/SearchCategoryAPI'
 
 
@@ -48,29 +67,62 @@ def words_api_params(language_id: str = 'en',
     }
 
 
+async def download_words(client: httpx.AsyncClient,
+                         language_ids: Iterable[str]) -> Dict[str, dict]:
+    """Fetch the words for all language_ids concurrently.
+    """
+    async def fetch(language_id: str) -> Tuple[str, dict]:
+        response = await client.get(
+            words_api_url,
+            params=words_api_params(language_id=language_id),
+            timeout=60)
+        response.raise_for_status()
+        logging.debug('Words for ' + language_id + ' Content-Encoding: ' +
+                      response.headers.get('Content-Encoding', 'identity'))
+        return language_id, orjson.loads(response.content)
+
+    return dict(await asyncio.gather(
+        *(fetch(language_id) for language_id in language_ids)))
+
+
 audio_base_url = base_url + '/res/keyword/audio'
-audio_pattern = re.compile('^([^_]+)-([0-9]+)$')
 audio_extension = '.mp3'
 
 
+@functools.lru_cache(maxsize=None)
+def split_raw_id(raw_id: str) -> Tuple[str, str]:
+    """Split a raw_id of the form '<level>-<number>'.
+    """
+    level, _, number = raw_id.rpartition('-')
+    return level, number
+
+
 def audio_filename(raw_id: str) -> str:
-    return audio_pattern.sub(r'\1W_\2', raw_id) + audio_extension
+    level, number = split_raw_id(raw_id)
+    return f'{level}W_{number}{audio_extension}'
 
 
 def audio_url(raw_id: str) -> str:
-    return audio_base_url + '/' + audio_pattern.sub(r'\1W/\1W_\2',
-                                                    raw_id) + audio_extension
+    level, number = split_raw_id(raw_id)
+    return f'{audio_base_url}/{level}W/{level}W_{number}{audio_extension}'
+
+
+@functools.lru_cache(maxsize=4096)
+def tags_for_attributes(
+        attributes: Tuple[Tuple[str, str, str, str], ...]) -> Tuple[str, ...]:
+    return tuple(
+        sorted({
+            tag
+            for level, utext, topic, lesson in attributes
+            for tag in (level, utext, 'Topic' + topic, 'Lesson' + lesson)
+        }))
 
 
 def extract_tags(attributes: Dict[str, Dict[str, str]]) -> List[str]:
-    mapped_attributes = [[
-        attribute['level'], attribute['utext'], 'Topic' + attribute['topic'],
-        'Lesson' + attribute['lesson']
-    ] for attribute in attributes]
-    flat_attributes = [
-        attribute for sublist in mapped_attributes for attribute in sublist
-    ]
-    return sorted(list(set(flat_attributes)))
+    return list(
+        tags_for_attributes(
+            tuple((attribute['level'], attribute['utext'], attribute['topic'],
+                   attribute['lesson']) for attribute in attributes)))
 
 
 def extract_rows(json_rep: dict) -> Iterator[List[str]]:
@@ -82,100 +134,319 @@ def extract_rows(json_rep: dict) -> Iterator[List[str]]:
         ]
 
 
-def is_downloaded(http_headers: Dict[str, str], path: str) -> bool:
+def http_date_to_epoch(http_date: str) -> float:
+    return email.utils.parsedate_to_datetime(http_date).timestamp()
+
+
+def online_file_state(
+        http_headers: Dict[str, str]) -> Optional[Tuple[int, float]]:
+    """Return the size and modification time announced in http_headers.
+
+    Returns None if the server did not send both.
+    """
+    if ('Content-Length' not in http_headers
+            or 'Last-Modified' not in http_headers):
+        return None
+    return (int(http_headers['Content-Length']),
+            http_date_to_epoch(http_headers['Last-Modified']))
+
+
+def is_downloaded(online_state: Tuple[int, float], path: str) -> bool:
     if not os.path.isfile(path):
         return False
+    online_file_size, online_modified_time = online_state
     local_file_size = os.path.getsize(path)
-    online_file_size = int(http_headers['Content-Length'])
     if local_file_size != online_file_size:
         return False
     local_modified_time = os.path.getmtime(path)
-    online_modified_time = time.mktime(
-        email.utils.parsedate(http_headers['Last-Modified']))
-    if local_modified_time != online_modified_time:
+    if not math.isclose(local_modified_time, online_modified_time, abs_tol=1):
         return False
     return True
 
 
-def download_audio(raw_ids: Iterable[str], prefix: str = 'media') -> None:
-    """Download audio files corresponding to raw_ids to prefix.
+def conditional_headers(path: str, etag: str = None) -> Dict[str, str]:
+    """Return validators for a conditional GET of the local copy at path.
+    """
+    headers = {}
+    if os.path.isfile(path):
+        headers['If-Modified-Since'] = email.utils.formatdate(
+            os.path.getmtime(path), usegmt=True)
+        if etag is not None:
+            headers['If-None-Match'] = etag
+    return headers
+
+
+Manifest = Dict[str, Dict[str, Union[int, float, str]]]
+
+manifest_filename = '.manifest.json'
+manifest_ttl = 7 * 24 * 60 * 60
+
+
+def load_manifest(prefix: str) -> Manifest:
+    try:
+        with open(os.path.join(prefix, manifest_filename)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest: Manifest, prefix: str) -> None:
+    """Atomically replace the manifest in prefix.
     """
-    if not os.path.isdir(prefix):
-        os.makedirs(prefix)
-    session = FuturesSession()
-    futures = {
-        raw_id: session.get(audio_url(raw_id), stream=True)
-        for raw_id in raw_ids
+    path = os.path.join(prefix, manifest_filename)
+    with open(path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def update_manifest(manifest: Manifest, raw_id: str, path: str,
+                    etag: str = None) -> None:
+    """Record the local copy at path as checked against the server now.
+    """
+    stat = os.stat(path)
+    entry = {
+        'size': stat.st_size,
+        'mtime': int(stat.st_mtime),
+        'checked': time.time()
     }
-    for raw_id, future in futures.items():
-        local_path = os.path.join(prefix, audio_filename(raw_id))
-        response = future.result()
+    if etag is None:
+        etag = manifest.get(raw_id, {}).get('etag')
+    if etag is not None:
+        entry['etag'] = etag
+    manifest[raw_id] = entry
+
+
+def is_recently_checked(manifest: Manifest, raw_id: str, path: str) -> bool:
+    entry = manifest.get(raw_id)
+    if entry is None or time.time() - entry['checked'] > manifest_ttl:
+        return False
+    stat = os.stat(path)
+    return (stat.st_size == entry['size']
+            and int(stat.st_mtime) == entry['mtime'])
+
+
+def save_audio(path: str, content: bytes,
+               modified_time: Optional[float] = None) -> None:
+    """Write content to path atomically and set its modification time.
+    """
+    partial_path = path + '.part'
+    try:
+        with open(partial_path, 'wb') as local_audio_file:
+            local_audio_file.write(content)
+        if modified_time is not None:
+            modified_time_ns = int(modified_time * 10**9)
+            os.utime(partial_path, ns=(modified_time_ns, modified_time_ns))
+        os.replace(partial_path, path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+
+tail_size = 16
+
+
+async def has_same_tail(client: httpx.AsyncClient, url: str, local_path: str,
+                        semaphore: asyncio.Semaphore) -> bool:
+    """Compare the last bytes of the audio file at url with local_path.
+    """
+    async with semaphore:
+        async with client.stream('GET',
+                                 url,
+                                 headers={'Range': f'bytes=-{tail_size}'},
+                                 timeout=audio_timeout) as response:
+            if response.status_code != httpx.codes.PARTIAL_CONTENT:
+                return False
+            online_tail = await response.aread()
+    with open(local_path, 'rb') as local_audio_file:
+        local_audio_file.seek(0, os.SEEK_END)
+        local_audio_file.seek(
+            max(local_audio_file.tell() - len(online_tail), 0))
+        return local_audio_file.read() == online_tail
+
+
+async def is_up_to_date(client: httpx.AsyncClient, raw_id: str, url: str,
+                        local_path: str,
+                        manifest: Manifest,
+                        semaphore: asyncio.Semaphore) -> Optional[bool]:
+    """Check the local copy at local_path against the audio file at url.
+
+    Files that match a recent manifest entry are considered up to date
+    without any request, others are checked with a HEAD request. If only
+    Last-Modified differs, a matching ETag or, lacking one, a matching
+    tail of the file is accepted as well. Returns None if the HEAD request
+    gives no verdict.
+    """
+    if is_recently_checked(manifest, raw_id, local_path):
+        logging.debug('Recently checked ' + local_path)
+        return True
+    try:
+        async with semaphore:
+            head = await client.head(url, timeout=audio_timeout)
+        if not head.is_success:
+            return None
+        online_state = online_file_state(head.headers)
+        if online_state is None:
+            return None
+        etag = head.headers.get('ETag')
+        if is_downloaded(online_state, local_path):
+            logging.debug('Already downloaded ' + local_path)
+        elif os.path.getsize(local_path) != online_state[0]:
+            return False
+        elif etag is not None:
+            if etag != manifest.get(raw_id, {}).get('etag'):
+                return False
+            logging.debug('Same ETag ' + local_path)
+        elif await has_same_tail(client, url, local_path, semaphore):
+            logging.debug('Same tail ' + local_path)
+        else:
+            return False
+    except httpx.HTTPError as error:
+        logging.warning('Could not check ' + local_path + ': ' + str(error))
+        return None
+    update_manifest(manifest, raw_id, local_path, etag)
+    return True
+
+
+async def fetch_audio(client: httpx.AsyncClient, raw_id: str, url: str,
+                      local_path: str,
+                      manifest: Manifest,
+                      semaphore: asyncio.Semaphore,
+                      conditional: bool = True) -> None:
+    """Download the audio file at url to local_path.
+
+    If conditional is set, an existing local copy is only replaced if the
+    server reports it as modified.
+    """
+    headers = {}
+    if conditional:
+        headers = conditional_headers(local_path,
+                                      manifest.get(raw_id, {}).get('etag'))
+    request = client.build_request('GET',
+                                   url,
+                                   headers=headers,
+                                   timeout=audio_timeout)
+    async with semaphore:
+        try:
+            response = await client.send(request, stream=True)
+        except httpx.HTTPError as error:
+            logging.warning('Could not download ' + local_path + ': ' +
+                            str(error))
+            return
         try:
+            if response.status_code == httpx.codes.NOT_MODIFIED:
+                logging.debug('Not modified ' + local_path)
+                update_manifest(manifest, raw_id, local_path,
+                                response.headers.get('ETag'))
+                return
             response.raise_for_status()
-            if not is_downloaded(response.headers, local_path):
-                logging.info('Downloading ' + local_path)
-                with open(local_path, 'wb') as local_audio_file:
-                    for chunk in response.iter_content(chunk_size=128):
-                        local_audio_file.write(chunk)
-                online_modified_time = time.mktime(
-                    email.utils.parsedate(response.headers['Last-Modified']))
-                os.utime(local_path,
-                         (online_modified_time, online_modified_time))
-            else:
-                logging.debug('Already downloaded ' + local_path)
-        except HTTPError:
-            logging.warning('Could not download ' + audio_filename(raw_id))
+            logging.info('Downloading ' + local_path)
+            content = await response.aread()
+            online_modified_time = None
+            if 'Last-Modified' in response.headers:
+                online_modified_time = http_date_to_epoch(
+                    response.headers['Last-Modified'])
+            await asyncio.get_running_loop().run_in_executor(
+                None, save_audio, local_path, content, online_modified_time)
+            update_manifest(manifest, raw_id, local_path,
+                            response.headers.get('ETag'))
+        except httpx.HTTPError as error:
+            logging.warning('Could not download ' + local_path + ': ' +
+                            str(error))
+        finally:
+            await response.aclose()
+
+
+async def verify_audio(client: httpx.AsyncClient, raw_id: str, url: str,
+                       local_path: str, manifest: Manifest,
+                       semaphore: asyncio.Semaphore) -> None:
+    """Download the audio file at url again if local_path is not up to date.
+    """
+    fresh = await is_up_to_date(client, raw_id, url, local_path, manifest,
+                                semaphore)
+    if not fresh:
+        await fetch_audio(client,
+                          raw_id,
+                          url,
+                          local_path,
+                          manifest,
+                          semaphore,
+                          conditional=fresh is None)
+
+
+async def download_audio(client: httpx.AsyncClient,
+                         raw_ids: Iterable[str],
+                         prefix: str = 'media',
+                         verify: bool = False) -> None:
+    """Download audio files corresponding to raw_ids to prefix.
 
+    Files already present in prefix are skipped without any request unless
+    verify is set, in which case they are checked against the server while
+    the missing ones download, and only changed ones are downloaded again.
+    """
+    os.makedirs(prefix, exist_ok=True)
+    manifest = load_manifest(prefix)
+    missing = []
+    existing = []
+    for raw_id in raw_ids:
+        local_path = os.path.join(prefix, audio_filename(raw_id))
+        audio_file = (raw_id, audio_url(raw_id), local_path)
+        if not os.path.isfile(local_path):
+            missing.append(audio_file)
+        elif verify:
+            existing.append(audio_file)
+    semaphore = asyncio.Semaphore(download_concurrency)
+    try:
+        await asyncio.gather(
+            *(fetch_audio(client, raw_id, url, local_path, manifest,
+                          semaphore)
+              for raw_id, url, local_path in missing),
+            *(verify_audio(client, raw_id, url, local_path, manifest,
+                           semaphore)
+              for raw_id, url, local_path in existing))
+    finally:
+        save_manifest(manifest, prefix)
 
-available_language_ids = ['en', 'es', 'id', 'th', 'zh', 'vi', 'fr']
 
-fields = """
-- name: RawId
-- name: 漢字・かな
-- name: かな
-- name: ローマ字
-- name: 翻訳
-- name: 音声
-"""
+available_language_ids = ['en', 'es', 'id', 'th', 'zh', 'vi', 'fr']
 
-templates = """
--
-  name: Card1
-  qfmt: >
-    {{音声}}
-    {{hint:漢字・かな}}<br/>
-    {{hint:かな}}<br/>
-    {{hint:ローマ字}}
-  afmt: >
-    {{FrontSide}}
-    <hr id=answer>
-      {{翻訳}}
-    </hr>
--
-  name: Card2
-  qfmt: >
-    {{漢字・かな}}<br/><br/>
-    {{hint:かな}}<br/>
-    {{hint:ローマ字}}
-  afmt: >
-    {{FrontSide}}
-    <hr id=answer>
-      {{音声}}
-      {{翻訳}}
-    </hr>
--
-  name: Card3
-  qfmt: >
-    {{翻訳}}
-  afmt: >
-    {{FrontSide}}
-    <hr id=answer>
-      {{音声}}
-      {{漢字・かな}}<br/><br/>
-      {{hint:かな}}<br/>
-      {{hint:ローマ字}}
-    </hr>
-"""
+fields = [
+    {'name': 'RawId'},
+    {'name': '漢字・かな'},
+    {'name': 'かな'},
+    {'name': 'ローマ字'},
+    {'name': '翻訳'},
+    {'name': '音声'},
+]
+
+templates = [
+    {
+        'name': 'Card1',
+        'qfmt': '{{音声}} {{hint:漢字・かな}}<br/> {{hint:かな}}<br/> '
+                '{{hint:ローマ字}}\n',
+        'afmt': '{{FrontSide}} <hr id=answer>\n'
+                '  {{翻訳}}\n'
+                '</hr>\n',
+    },
+    {
+        'name': 'Card2',
+        'qfmt': '{{漢字・かな}}<br/><br/> {{hint:かな}}<br/> {{hint:ローマ字}}\n',
+        'afmt': '{{FrontSide}} <hr id=answer>\n'
+                '  {{音声}}\n'
+                '  {{翻訳}}\n'
+                '</hr>\n',
+    },
+    {
+        'name': 'Card3',
+        'qfmt': '{{翻訳}}\n',
+        'afmt': '{{FrontSide}} <hr id=answer>\n'
+                '  {{音声}}\n'
+                '  {{漢字・かな}}<br/><br/>\n'
+                '  {{hint:かな}}<br/>\n'
+                '  {{hint:ローマ字}}\n'
+                '</hr>\n',
+    },
+]
 
 style = """
 .card {
@@ -197,30 +468,82 @@ class MarugotoNote(Note):
         return genanki.guid_for(self.fields[0])
 
 
-def export_words(words: Words, file: str, media_prefix: str = 'media') -> None:
+def build_package(words: Words, media_prefix: str = 'media') -> Package:
     deck = Deck(deck_id=1336548074,
                 name=base_name,
                 description='This deck was created using Marugoto Scraper.')
+    media_files = []
     for word in words:
+        filename = audio_filename(word['RAWID'])
+        media_files.append(media_prefix + '/' + filename)
         deck.add_note(
             MarugotoNote(model=model,
                          fields=[
                              word['RAWID'], word['KANJI'], word['KANA'],
                              word['ROMAJI'], word['UWRD'],
-                             '[sound:' + audio_filename(word['RAWID']) + ']'
+                             '[sound:' + filename + ']'
                          ],
                          tags=extract_tags(word['ATTR'])))
 
     package = Package(deck)
-    package.media_files = [
-        media_prefix + '/' + audio_filename(word['RAWID']) for word in words
-    ]
-    package.write_to_file(file)
+    package.media_files = media_files
+    return package
+
+
+package_buffer_size = 4 * 1024 * 1024
+
+
+def write_package(package: Package, file: str) -> None:
+    """Write package to file atomically.
+    """
+    temp_path = file + '.tmp'
+    try:
+        with open(temp_path, 'wb',
+                  buffering=package_buffer_size) as package_file:
+            package.write_to_file(package_file)
+        os.replace(temp_path, file)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def export_words(words: Words, file: str, media_prefix: str = 'media') -> None:
+    write_package(build_package(words, media_prefix), file)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description='Scrape ' + base_name +
+                                     ' into Anki packages.')
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help='check already downloaded audio files against '
+                        'the server')
+    parser.add_argument('--language',
+                        action='append',
+                        choices=available_language_ids,
+                        dest='language_ids',
+                        help='language of the translations, can be given '
+                        'multiple times (default: en)')
+    args = parser.parse_args()
+    language_ids = list(dict.fromkeys(args.language_ids or ['en']))
+    async with create_client() as client:
+        json_reps = await download_words(client, language_ids)
+        loop = asyncio.get_running_loop()
+        _, packages = await asyncio.gather(
+            download_audio(
+                client, {
+                    word['RAWID']
+                    for json_rep in json_reps.values()
+                    for word in json_rep['DATA']
+                },
+                verify=args.verify),
+            asyncio.gather(*(loop.run_in_executor(None, build_package,
+                                                  json_rep['DATA'])
+                             for json_rep in json_reps.values())))
+    for language_id, package in zip(json_reps, packages):
+        write_package(package, base_name + '-' + language_id + '.apkg')
 
 
 if __name__ == '__main__':
-    language_id = 'en'
-    r = requests.get(words_api_url,
-                     params=words_api_params(language_id=language_id)).json()
-    download_audio(word['RAWID'] for word in r['DATA'])
-    export_words(r['DATA'], base_name + '-' + language_id + '.apkg')
+    asyncio.run(main())